@@ -8,34 +8,91 @@ Friedrich-Alexander-Universität Erlangen-Nürnberg)
 @contact: cris-support@fau.de
 """
 
+import io
 import re
 import collections
-from urllib import request as urllib_request
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
+from requests.adapters import HTTPAdapter
 from lxml import etree
 
+# optional, only needed for BibTeX export
+try:
+    import bibtexparser
+    from bibtexparser.bibdatabase import BibDatabase as _BibDatabase
+except ImportError:
+    bibtexparser = None
+
 SORT_ASC = 1
 SORT_DESC = 2
 
+# no ID index, whitespace-only text or entity expansion needed for our data
+_PARSER_OPTIONS = dict(
+    collect_ids=False, remove_blank_text=True, resolve_entities=False)
+_PARSER = etree.XMLParser(**_PARSER_OPTIONS)
+
+# words in publication titles (for masking capital letters in BibTeX)
+_TITLE_MASK_RE = re.compile(r'(\W+)?(\w+)(\W+)?')
+
 
 class FauCris:
     def __init__(self):
         self.base = "https://cris.fau.de/ws-cached/1.0/public/infoobject/"
+        # number of requests issued in parallel
+        self.workers = 8
 
-    @staticmethod
-    def open(url):
+        # keep connections alive between requests (saves TLS handshakes)
+        self._session = requests.Session()
+        self._session.mount(
+            'https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+        # raw data of recent requests that parsed completely (url -> bytes),
+        # repeated queries are answered without another round trip
+        self._cache = collections.OrderedDict()
+        self._cacheSize = 256
+
+    def open(self, url):
         """
-        return connection for reading. respects redirects.
+        return response data for reading. respects redirects.
 
         :param url: address to fetch from
-        :return: raw data (unicode)
+        :return: raw data (file-like object)
         """
 
-        response = urllib_request.urlopen(url)
-        if response.getcode() != 200:
-            raise Exception("unsuccessful request")
+        data = self._cache.get(url)
+        if data is None:
+            data = self._read(url)
 
-        return response
+        return io.BytesIO(data)
+
+    def _remember(self, url, data):
+        """
+        put raw data of a completely parsed response into the cache; least
+        recently used entries are dropped if the cache is full.
+
+        :param url: address data was fetched from
+        :param data: raw data (bytes)
+        """
+
+        self._cache[url] = data
+        self._cache.move_to_end(url)
+        while len(self._cache) > self._cacheSize:
+            self._cache.popitem(last=False)
+
+    def _read(self, url):
+        """
+        issue request and read complete response body.
+
+        :param url: address to fetch from
+        :return: raw data (bytes)
+        """
+
+        response = self._session.get(url, timeout=30)
+        if response.status_code != 200:
+            raise requests.HTTPError("unsuccessful request", response=response)
+
+        return response.content
 
     def get(self, identifier, selector=None):
         """
@@ -45,11 +102,15 @@ class FauCris:
         :param selector: filter object (currently not used)
         :return: root element of xml (etree)
         """
+        url = self.base + identifier
         try:
-            xml = etree.parse(self.open(self.base + identifier))
+            source = self.open(url)
+            xml = etree.parse(source, _PARSER)
         except Exception as e:
             raise Exception("request failed: " + ", ".join(e.args))
 
+        self._remember(url, source.getvalue())
+
         return xml.getroot()
 
     def retrieve(self, reqs, _class, selector=None):
@@ -67,33 +128,62 @@ class FauCris:
         if selector is not None and not isinstance(selector, Selector):
             selector = Selector(selector)
 
-        data = []
-        for _r in reqs:
-            try:
-                _x = self.get(_r, selector)
-            except:
-                continue
-            data.append(_x)
+        # requests are independent, so overlap their latency
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # each distinct request is issued only once
+            urls = [self.base + _r for _r in dict.fromkeys(reqs)]
+            futures = [pool.submit(self.open, _u) for _u in urls]
 
         result = {}
-        for _x in data:
-            # split into single datasets
+        for _u, _f in zip(urls, futures):
             try:
-                _l = _x.xpath(_class.xpath)
-            except:
-                raise Exception("invalid xml data or xpath")
+                source = _f.result()
+            except OSError:
+                # connection problems and unsuccessful requests
+                continue
 
-            # generate classes out of each dataset
-            for _s in _l:
-                dataset = _class(_s)
+            datasets = {}
+            try:
+                # split into single datasets and generate classes out of each
+                for _s in self._iterObjects(source, _class.infotype):
+                    dataset = _class(_s)
+
+                    # unique list by id of dataset
+                    # apply filter is defined
+                    if dataset['id'] and (selector is None or selector.evaluate(dataset)):
+                        datasets[dataset['id']] = dataset
+            except etree.XMLSyntaxError:
+                # skip the whole response, it may be truncated
+                continue
 
-                # unique list by id of dataset
-                # apply filter is defined
-                if dataset['id'] and (selector is None or selector.evaluate(dataset)):
-                    result[dataset['id']] = dataset
+            # cache only responses that parsed completely
+            self._remember(_u, source.getvalue())
+            result.update(datasets)
 
         return result
 
+    @staticmethod
+    def _iterObjects(source, infotype):
+        """
+        Stream-parse raw data and yield datasets of the given type. Elements
+        are discarded once processed, so only one dataset is kept in memory.
+
+        :param source: raw data (file-like object)
+        :param infotype: value of the type attribute of wanted datasets
+        :return: generator of infoObject elements (etree)
+        """
+
+        for _, elem in etree.iterparse(source, events=('end',), tag='infoObject',
+                                       **_PARSER_OPTIONS):
+            if elem.get('type') == infotype:
+                yield elem
+
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+
     def _fetch(self, name, class_, request_templates, ids=None, selector=None):
         """
         helper method for requesting data.
@@ -106,23 +196,28 @@ class FauCris:
         :return: data objects
         """
 
-        if ids is None or ids == '0':
-            raise Exception("Please supply valid id for %s." % name)
+        idlist = self._checkIds(name, ids)
+        reqs = [t % _i for _i in idlist for t in request_templates]
 
-        idlist = self._parseId(ids)
+        response = self.retrieve(reqs, class_, selector)
+        return response
 
-        reqs = []
-        for _i in idlist:
-            try:
-                _i = int(_i)
-            except ValueError:
-                raise Exception("invalid %s id number" % name)
+    def _checkIds(self, name, ids):
+        """
+        Validate id data and process it for multiple values
 
-            for t in request_templates:
-                reqs.append(t % _i)
+        :param name: name used for error messages
+        :param ids: id data (will be fed to _parseId method)
+        :return: tuple of unique ids (int)
+        """
 
-        response = self.retrieve(reqs, class_, selector)
-        return response
+        if ids is None or ids == '0':
+            raise Exception("Please supply valid id for %s." % name)
+
+        try:
+            return self._parseId(ids)
+        except ValueError:
+            raise Exception("invalid %s id number" % name)
 
     @staticmethod
     def _parseId(idvalue):
@@ -130,23 +225,19 @@ class FauCris:
         Process id for multiple values
 
         :param idvalue: iterable, text or integer
-        :return: list of ids
+        :return: tuple of unique ids (int), in given order
         """
 
         # just number
-        if type(idvalue) == int:
-            return [idvalue]
-
-        # text
-        if type(idvalue) == str:
-            # list of ids
-            if ',' in idvalue:
-                return [_i.strip() for _i in idvalue.split(',')]
-            else:
-                # just text
-                return [idvalue]
+        if isinstance(idvalue, int):
+            return (idvalue,)
+
+        # text, may be a list of ids
+        if isinstance(idvalue, str):
+            idvalue = idvalue.split(',')
 
-        return idvalue
+        # drop duplicates, they would cause redundant requests
+        return tuple(dict.fromkeys(int(_i) for _i in idvalue))
 
 
 class Usertags(FauCris):
@@ -177,6 +268,8 @@ class Publications(FauCris):
     """
     def __init__(self):
         super(Publications, self).__init__()
+        # organization id -> flag if not on (sub-)root level
+        self._leafOrgas = {}
 
     def by_orga(self, id_=None, selector=None, disable_orga_check=False):
         """
@@ -189,14 +282,22 @@ class Publications(FauCris):
         """
 
         # check if orga is not on (sub-)root level
+        # (hierarchy does not change, so each organization is checked once)
         if not disable_orga_check:
-            template = ['get/Organisation/%d']
-            orgas = self._fetch('organization', Organization, template, id_)
+            ids = self._checkIds('organization', id_)
+            missing = [_i for _i in ids if _i not in self._leafOrgas]
+            if missing:
+                template = ['get/Organisation/%d']
+                orgas = self._fetch('organization', Organization, template,
+                                    missing)
+
+                for _o in orgas.values():
+                    self._leafOrgas[int(_o['id'])] = \
+                        not _o['fau_org_nr'].endswith('000000')
 
-            for _, _o in orgas.items():
-                if _o['fau_org_nr'].endswith('000000'):
-                    raise ValueError(
-                              'root and subroot level organization not allowed')
+            if not all(self._leafOrgas.get(_i, True) for _i in ids):
+                raise ValueError(
+                          'root and subroot level organization not allowed')
 
         template = [
             "getautorelated/Organisation/%d/ORGA_2_PUBL_1",
@@ -246,6 +347,8 @@ class CrisEntity:
     """
     CRIS webservice entity.
     """
+    __slots__ = ('_data',)
+
     def __init__(self, initial_data=None):
         if initial_data is None:
             return
@@ -257,23 +360,23 @@ class CrisEntity:
             data[_i.lower()] = initial_data.get(_i)
 
         # value mapping
-        for _c in initial_data.getchildren():
+        for _c in initial_data:
             # skip "relation", etc.
             if _c.tag.lower() != 'attribute':
                 continue
 
-            name = _c.get("name").lower()
-            if _c.get("language") == '1':
+            get = _c.get
+            name = get("name").lower()
+            if get("language") == '1':
                 name += '_en'
 
-            if _c.get("disposition") == 'choicegroup':
-                try:
-                    value = _c.xpath('./additionalInfo')[0].text
-                except:
-                    value = None
-                data["%s_id" % name] = _c.xpath('./data')[0].text
+            _d = _c.find('data')
+            if get("disposition") == 'choicegroup':
+                _a = _c.find('additionalInfo')
+                value = _a.text if _a is not None else None
+                data["%s_id" % name] = _d.text
             else:
-                value = _c.xpath('./data')[0].text
+                value = _d.text
 
             data[name] = value
 
@@ -287,7 +390,8 @@ class Organization(CrisEntity):
     """
     Single organization object
     """
-    xpath = "//infoObject[@type='Organisation']"
+    __slots__ = ()
+    infotype = 'Organisation'
 
     def __init__(self, initial_data=None):
         super(Organization, self).__init__(initial_data)
@@ -297,7 +401,8 @@ class Usertag(CrisEntity):
     """
     Single usertag object
     """
-    xpath = "//infoObject[@type='usertag']"
+    __slots__ = ()
+    infotype = 'usertag'
 
     def __init__(self, initial_data=None):
         super(Usertag, self).__init__(initial_data)
@@ -307,24 +412,23 @@ class Publication(CrisEntity):
     """
     Single publication object
     """
-    xpath = "//infoObject[@type='Publication']"
+    __slots__ = ()
+    infotype = 'Publication'
 
     def __init__(self, initial_data=None):
         super(Publication, self).__init__(initial_data)
 
     def __repr__(self):
         try:
-            t = ' (%s: %s%s)' % (
-                self._data['publyear'],
-                self._data['cftitle'][:50],
-                len(self._data['cftitle']) > 50 and '...' or ''
-            )
-        except:
+            title = self._data['cftitle']
+            suffix = '...' if len(title) > 50 else ''
+            t = f" ({self._data['publyear']}: {title[:50]}{suffix})"
+        except (AttributeError, KeyError, TypeError):
             t = ''
         try:
-            return 'CRIS publication #%s%s' % (self._data['id'], t)
-        except KeyError:
-            return 'Publication object (%d)' % id(self)
+            return f"CRIS publication #{self._data['id']}{t}"
+        except (AttributeError, KeyError):
+            return f'Publication object ({id(self)})'
 
     def toBibTeX(self, mask_caps=True, override_id=None):
         """
@@ -336,9 +440,7 @@ class Publication(CrisEntity):
 
         :return: {string} BibTeX data
         """
-        try:
-            import bibtexparser
-        except ImportError:
+        if bibtexparser is None:
             raise Exception('Please install "bibtexparser" module!')
 
         # map basic attributes
@@ -382,78 +484,74 @@ class Publication(CrisEntity):
         else:
             bibtype = types.get(publtype, 'misc')
 
-        # valid for all types
-        bibdata = {
-            # later versions of bibtexparser require upper case: ID
-            'id': 'faucris.%s' % (data['id']),
-            # later versions of bibtexparser required ENTRYTYPE instead of type
-            'type': bibtype,
-            'year': data['publyear'],
-            'title': data['cftitle'],
-            'note': data['note'],
-            'keywords': data['keywords'],
-            'abstract': data['cfabstr'],
-            'month': data['monthcg_id'],
-            'url': data['cfuri'],
-            'peerreviewed': data['peerreviewed'],
-            'faupublication': data['fau publikation'],
-            'doi': data['doi'],
-        }
-
-        if override_id:
-            bibdata['id'] = override_id
+        bibdata = {}
 
-        if bibdata['abstract'] is not None and bibdata['abstract'].startswith('<p>'):
-            bibdata['abstract'] = bibdata['abstract'][3:-6].strip()
+        def add(key, value):
+            # "None" attributes are not exported
+            if value is not None:
+                bibdata[key] = value
 
-        if bibdata['month'] is not None:
-            try:
-                bibdata['month'] = months.get(bibdata['month'], None)
-            except:
-                bibdata['month'] = None
+        # valid for all types
+        # later versions of bibtexparser require upper case: ID
+        add('id', override_id or 'faucris.%s' % (data['id']))
+        # later versions of bibtexparser required ENTRYTYPE instead of type
+        add('type', bibtype)
+        add('year', data.get('publyear'))
+        add('title', data.get('cftitle'))
+        add('note', data.get('note'))
+        add('keywords', data.get('keywords'))
+        add('url', data.get('cfuri'))
+        add('peerreviewed', data.get('peerreviewed'))
+        add('faupublication', data.get('fau publikation'))
+        add('doi', data.get('doi'))
+        add('month', months.get(data.get('monthcg_id')))
+
+        abstract = data.get('cfabstr')
+        if abstract is not None and abstract.startswith('<p>'):
+            abstract = abstract[3:-6].strip()
+        add('abstract', abstract)
 
         # type dependent
-        if bibdata['type'] in ('article'):
-            bibdata['journal'] = data['journalname']
-            bibdata['volume'] = data['book volume']
-            bibdata['pages'] = data['pagesrange']
-
-        if bibdata['type'] in ('book', 'incollection', 'editorial', 'inproceedings'):
-            bibdata['publisher'] = data['publisher']
-            bibdata['editor'] = data['editor']
-            bibdata['isbn'] = data['cfisbn']
-            bibdata['volume'] = data['book volume']
-            bibdata['series'] = data['cfseries']
-            bibdata['edition'] = data['cfedition']
-            bibdata['address'] = data['cfcitytown']
-            bibdata['pages'] = data['pagesrange']
-
-        if bibdata['type'] in ('incollection'):
-            bibdata['booktitle'] = data['edited volumes']
-
-        if bibdata['type'] in ('inproceedings') or \
-                (bibdata['type'] in ('unpublished') and data['futurepublicationtype'].lower() == 'conference contribution'):
-            bibdata['booktitle'] = data['conference proceedings title']
+        if bibtype in ('article'):
+            add('journal', data.get('journalname'))
+            add('volume', data.get('book volume'))
+            add('pages', data.get('pagesrange'))
+
+        if bibtype in ('book', 'incollection', 'editorial', 'inproceedings'):
+            add('publisher', data.get('publisher'))
+            add('editor', data.get('editor'))
+            add('isbn', data.get('cfisbn'))
+            add('volume', data.get('book volume'))
+            add('series', data.get('cfseries'))
+            add('edition', data.get('cfedition'))
+            add('address', data.get('cfcitytown'))
+            add('pages', data.get('pagesrange'))
+
+        if bibtype in ('incollection'):
+            add('booktitle', data.get('edited volumes'))
+
+        if bibtype in ('inproceedings') or \
+                (bibtype in ('unpublished') and data['futurepublicationtype'].lower() == 'conference contribution'):
             # try to use conference name as fall-back
-            if bibdata['booktitle'] is None or not len(bibdata['booktitle']):
-                bibdata['booktitle'] = data['event title']
-            bibdata['venue'] = data['event location']
-            bibdata['date'] = data['event start date']
-            if bibdata['date'] is not None and data['event end date'] is not None:
-                bibdata['date'] += '/' + data['event end date']
+            add('booktitle', data.get('conference proceedings title') or
+                data.get('event title'))
+            add('venue', data.get('event location'))
+            date = data.get('event start date')
+            if date is not None and data.get('event end date') is not None:
+                date += '/' + data['event end date']
+            add('date', date)
 
-        if bibdata['type'] in ('phdthesis', 'masterthesis'):
-            bibdata['school'] = 'Friedrich-Alexander-Universität Erlangen-Nürnberg'
+        if bibtype in ('phdthesis', 'masterthesis'):
+            add('school', 'Friedrich-Alexander-Universität Erlangen-Nürnberg')
 
-        if bibdata['type'] == 'unpublished' and not bibdata['note']:
-            bibdata['note'] = \
-                'https://cris.fau.de/converis/publicweb/Publication/%s' % data['id']
+        if bibtype == 'unpublished' and not bibdata.get('note'):
+            add('note',
+                'https://cris.fau.de/converis/publicweb/Publication/%s' % data['id'])
 
         try:
             author_editor = ' and '.join(
-                ['%s, %s' % (_i, _j) for _i, _j in
-                    [_k.split(':') for _k in data['exportauthors'].split('|')]
-                ]
+                '%s, %s' % tuple(_k.split(':', 1))
+                for _k in data['exportauthors'].split('|')
             )
         except AttributeError:
             # exportauthors is set non-live, so it may be missing
@@ -465,7 +563,7 @@ class Publication(CrisEntity):
             author_editor += " and et al."
             bibdata['support_note'] = 'Author relations incomplete. ' + \
                 'You may find additional data in field \'author_hint\''
-            bibdata['author_hint'] = data.get('srcauthors', '')
+            add('author_hint', data.get('srcauthors', ''))
 
         if publtype == 'editorial':
             bibdata['editor'] = author_editor
@@ -473,26 +571,21 @@ class Publication(CrisEntity):
             bibdata['author'] = author_editor
 
         # enclosing capital letters in title (default)
-        if mask_caps:
-            elements = re.findall('(\W+)?(\w+)(\W+)?', bibdata['title'])
-            _t = ''
-            for _i in elements:
-                if not _i[1].islower() and not _i[1].isdigit():
-                    _t += '%s{%s}%s' % _i
-                else:
-                    _t += '%s%s%s' % _i
+        if mask_caps and 'title' in bibdata:
+            _t = ''.join(
+                ('%s{%s}%s' if not _i[1].islower() and not _i[1].isdigit()
+                 else '%s%s%s') % _i
+                for _i in _TITLE_MASK_RE.findall(bibdata['title'])
+            )
             # remove double masks
             _t = _t.replace('{{', '{').replace('}}', '}')
             bibdata['title'] = _t
 
-        bibdb = bibtexparser.bibdatabase.BibDatabase()
+        bibdb = _BibDatabase()
 
-        # kick "None" attributes and mask underscores
-        _n = {
-            k: v.replace('_', '{\\_}') for k, v in bibdata.items()
-              if v is not None
-        }
-        bibdb.entries.append(_n)
+        # mask underscores
+        bibdb.entries.append(
+            {k: v.replace('_', '{\\_}') for k, v in bibdata.items()})
 
         return bibtexparser.dumps(bibdb)
 
@@ -501,6 +594,8 @@ class Selector:
     """
     Filter object for CRIS data.
     """
+    __slots__ = ('selectors',)
+
     def __init__(self, criteria):
         """
         Parse filter operators.
@@ -535,7 +630,11 @@ class Selector:
             v = str(criteria.get(k))
             flist[op[0]][op[1]] = v
 
-        self.selectors = flist
+        # resolve compare methods once, not per evaluated dataset
+        self.selectors = {
+            _a: [(getattr(str, '__%s__' % _o), _v.lower()) for _o, _v in _s.items()]
+            for _a, _s in flist.items()
+        }
 
     def evaluate(self, dataset):
         """
@@ -554,9 +653,8 @@ class Selector:
                 # the test successful and may be therefore a bad idea.
                 continue
 
-            for _o, _v in _s.items():
-                method = getattr(value, '__%s__' % _o)
-                if method(_v) is False:
+            for method, _v in _s:
+                if method(value, _v) is False:
                     return False
 
         return True
@@ -567,6 +665,8 @@ class Formatter:
     Group and sort data in up to two levels. Method "execute" returns
     reformatted data.
     """
+    __slots__ = ('group_by', 'group_order', 'sort_by', 'sort_order')
+
     def __init__(self, group_by, group_order=SORT_DESC, sort_by=None,
                  sort_order=SORT_ASC):
         """
@@ -602,14 +702,14 @@ class Formatter:
         """
         Perform reformatting.
 
-        :param data: CRIS data object
+        :param data: CRIS data objects (dict as returned by requests or list)
         :return: ordered list of groups containing sorted data objects
         """
 
         unsorted = {}
 
         # group data
-        for _, d in data.items():
+        for d in (data.values() if isinstance(data, dict) else data):
             try:
                 groupvalue = (d['%s' % self.group_by]).lower()
             except KeyError:
@@ -618,10 +718,7 @@ class Formatter:
                 if self.group_by is None:
                     groupvalue = self.sort_by
 
-            if groupvalue not in unsorted.keys():
-                unsorted[groupvalue] = []
-
-            unsorted[groupvalue].append(d)
+            unsorted.setdefault(groupvalue, []).append(d)
 
         # sort inside groups
         if self.group_order in (SORT_ASC, SORT_DESC):
@@ -632,7 +729,7 @@ class Formatter:
 
             # Put missing values at the end (we have more/other values in actual
             # data than listed in group_order).
-            missing = set(unsorted.keys()) - set(keylist)
+            missing = unsorted.keys() - set(keylist)
             if missing:
                 keylist.extend(list(missing))
 
@@ -649,7 +746,7 @@ class Formatter:
 
             # sort by attribute
             try:
-                _x = sorted(unsorted[k], key=lambda y: y[self.sort_by],
+                _x = sorted(unsorted[k], key=lambda y, a=self.sort_by: y._data.get(a),
                         reverse=(self.sort_order == SORT_DESC))
             except TypeError:
                 raise Exception('Cannot sort by unset attribute.')